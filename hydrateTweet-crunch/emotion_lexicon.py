@@ -4,12 +4,15 @@ import csv
 import spacy
 from enum import Enum
 from . import utils
-from typing import Counter, Dict, Iterator, List
+from typing import Counter, Dict, Iterable, Iterator, List
 
 EMOTIONS = ["Positive", "Negative", "Anger", "Anticipation", "Disgust", "Fear", "Joy", "Sadness", "Surprise", "Trust"]
 
 SPACY_SUPP_LANG = {'en': 'en_core_web_sm', 'es': 'es_core_news_sm', 'it': 'it_core_news_sm'}
 
+# default tokenizer, used when the language is not supported by spacy
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
 class Emotions(Enum):
     ANGER = 1 << 0
     ANTICIPATION = 1 << 1
@@ -54,13 +57,16 @@ def getEmotionName(emotion: Emotions) -> str:
         return "analized words"
     return "unknown"
 
-def initEmotionLexicon(lang = 'en') -> bool:
+def initEmotionLexicon(lang = 'en', load_tokenizer: bool = True) -> bool:
     emotionOrder = [
         Emotions.POSITIVE, Emotions.NEGATIVE, Emotions.ANGER, Emotions.ANTICIPATION, Emotions.DISGUST,
         Emotions.FEAR, Emotions.JOY, Emotions.SADNESS, Emotions.SURPRISE, Emotions.TRUST
     ]
     path = 'hydrateTweet-crunch/assets/NRC-Emotion-Lexicon-v0.92-In105Languages-Nov2017Translations.csv'
 
+    # only the words of lang, not the ones left by a previous language
+    dic.clear()
+
     with open(path) as csv_file:
         csv_reader = csv.DictReader(csv_file)
         for i, line in enumerate(csv_reader):
@@ -83,6 +89,10 @@ def initEmotionLexicon(lang = 'en') -> bool:
                     emotions.append(emotionOrder[j])
             dic[term] = emotions
 
+    # a process that never tokenizes only needs the lexicon
+    if not load_tokenizer:
+        return True
+
     if lang in SPACY_SUPP_LANG:
         utils.log(f'Loading {lang} for spacy')
         global nlp
@@ -98,8 +108,19 @@ def tokenize(text: str) -> Iterator[str]:
         for word in nlp(u'{}'.format(text)):
             yield word.text
     else:
-        for match in re.finditer(r'\w+', text, re.UNICODE):
-            yield match.group(0)
+        yield from TOKEN_RE.findall(text)
+
+def tokenizeMany(texts: Iterable[str], batch_size: int = 1000) -> Iterator[List[str]]:
+    """Tokenize a stream of texts, yielding the list of words of each one of them in order.
+       spacy processes the texts in batches of batch_size with nlp.pipe.
+    """
+    if nlp:
+        for doc in nlp.pipe(texts, batch_size=batch_size):
+            yield [word.text for word in doc]
+    else:
+        findall = TOKEN_RE.findall
+        for text in texts:
+            yield findall(text)
 
 def isWordOfEmotion(word: str, emotion: Emotions) -> bool:
     if word in dic:
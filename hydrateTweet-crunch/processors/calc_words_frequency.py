@@ -10,15 +10,22 @@ import re
 import argparse
 import datetime
 import math
+import heapq
+import concurrent.futures
+import multiprocessing
+import more_itertools
+import numpy as np
 from pathlib import Path
+from collections import deque
+from itertools import chain
 
-from typing import Iterable, Iterator, Mapping, Counter
+from typing import Dict, Iterable, Iterator, List, Mapping, Counter
 
 from .. import file_utils as fu
 from .. import dumper
 from .. import custom_types
 from .. import utils
-from ..emotion_lexicon import initEmotionLexicon, Emotions, getEmotionName, tokenize, getEmotionsOfWord
+from ..emotion_lexicon import initEmotionLexicon, Emotions, getEmotionName, tokenizeMany, getEmotionsOfWord, dic
 
 from operator import itemgetter
 from pprint import pprint
@@ -26,6 +33,12 @@ from pprint import pprint
 # print a dot each NTWEET tweets
 NTWEET = 10000
 
+# number of tweets counted by a worker process at a time
+CHUNK_SIZE = 5000
+
+# split the basename of the input file on '-' and '.'
+_BASENAME_SPLIT = re.compile(r'[-.]').split
+
 # templates
 stats_template = '''
 <stats>
@@ -41,6 +54,41 @@ stats_template = '''
 '''
 
 RELEVANT_EMOTIONS = ["positive", "negative", "anger", "anticipation", "disgust", "fear", "joy", "sadness", "surprise", "trust"]
+RELEVANT_EMOTIONS_SET = frozenset(RELEVANT_EMOTIONS)
+
+# name of each relevant emotion of the lexicon, the others are left out
+EMOTION_ID_TO_NAME = {
+    emotion: getEmotionName(emotion)
+    for emotion in Emotions
+    if getEmotionName(emotion) in RELEVANT_EMOTIONS_SET
+}
+
+# index of the lexicon, rebuilt by init_word_index every time the lexicon is initialised:
+# the id of each word, the words by id and, for each word, whether it belongs to at least
+# one of the RELEVANT_EMOTIONS
+_WORD_IDS: Dict[str, int] = {}
+_WORDS = np.empty(0, dtype=object)
+_RELEVANT_WORD = np.zeros(0, dtype=bool)
+
+
+def init_word_index() -> None:
+    """Index the words of the lexicon, so that the words of a chunk of tweets can be counted
+       on an array of ids with numpy.
+    """
+    global _WORDS, _RELEVANT_WORD
+
+    words = list(dic)
+
+    _WORD_IDS.clear()
+    _WORD_IDS.update(zip(words, range(len(words))))
+
+    _WORDS = np.array(words, dtype=object)
+    _RELEVANT_WORD = np.fromiter(
+        (any(emotion in EMOTION_ID_TO_NAME for emotion in getEmotionsOfWord(word)) for word in words),
+        dtype=bool,
+        count=len(words)
+    )
+
 
 def get_valid_users(args: argparse.Namespace):
     if os.path.exists(args.users_file):
@@ -82,83 +130,151 @@ def process_lines(
             utils.log('The file of valid users could not be found\n')
             return None
     
-    if initEmotionLexicon(lang=lang):
-
-        process_tweet(
-            first,
-            stats=stats,
-            words_dict=words_dict,
-            valid_users=valid_users,
-            args=args
-        )
-        for raw_obj in dump:
-            process_tweet(
-                raw_obj,
-                stats=stats,
-                words_dict=words_dict,
-                valid_users=valid_users,
-                args=args
-            )
+    # spacy is loaded in the main process only if it counts the words itself, or if the
+    # workers are forked from it and inherit it
+    load_tokenizer = args.processes <= 1 or workers_inherit_lexicon()
+    if initEmotionLexicon(lang=lang, load_tokenizer=load_tokenizer):
+        init_word_index()
+
+        # put back the first tweet, it was only needed to know the language
+        tweets = chain([first], dump)
+        if args.users_file:
+            # compare the numeric ids, the id of each author doesn't need to be converted to str
+            valid_ids = {int(user_id) for user_id in valid_users if user_id.isdigit()}
+            tweets = (tweet for tweet in tweets if tweet['user']['id'] in valid_ids)
+
+        texts = (tweet['full_text'] for tweet in tweets)
+        input_stats = stats['performance']['input']
+
+        for chunk_dict in count_chunks(more_itertools.chunked(texts, CHUNK_SIZE), lang, args):
+            words_dict['occurrences'] += chunk_dict['occurrences']
+            words_dict['words'] += chunk_dict['words']
+            input_stats['words'] += chunk_dict['words']
+
+            # a dot each NTWEET tweets, as if they were counted one by one
+            nobjs = input_stats['tweets']
+            words_dict['tweets'] += chunk_dict['tweets']
+            input_stats['tweets'] += chunk_dict['tweets']
+            for _ in range((input_stats['tweets']-1) // NTWEET - (nobjs-1) // NTWEET):
+                utils.dot()
         return lang
     else:
         return None
 
 
-def process_tweet(
-    tweet: dict,
-    stats: Mapping,
-    words_dict: dict,
-    valid_users,
-    args: argparse.Namespace):
-    """Analyze the words in a tweet and save their occurrences w.r.t. their emotion
+def new_words_dict() -> dict:
+    """Return an empty words_dict: the occurrences of the words and the totals.
+
+       A word occurs the same number of times in each one of its emotions, so a single
+       Counter keyed by word is kept and split by emotion only in get_first_n_words.
     """
+    words_dict:dict = {}
 
-    full_text = tweet['full_text']
-    user_id = str(tweet['user']['id'])
+    words_dict['occurrences'] = Counter()
+    words_dict['words'] = 0
+    words_dict['tweets'] = 0
+    return words_dict
 
-    if args.users_file and not user_id in valid_users:
-        return
 
-    for word in tokenize(full_text):
-        emotions = getEmotionsOfWord(word)
+def workers_inherit_lexicon() -> bool:
+    """Whether the worker processes are forked, inheriting the lexicon of the main process."""
+    return multiprocessing.get_start_method() == 'fork'
 
-        # Check if the list is empty
-        if emotions:
-            stats['performance']['input']['words'] += 1
-            words_dict['words'] += 1
 
-        for emotion in emotions:
-            emotion = getEmotionName(emotion)
-            if emotion in RELEVANT_EMOTIONS:
-                if not word in words_dict[emotion]:
-                    words_dict[emotion][word] = 1
-                else:
-                    words_dict[emotion][word] += 1
+def init_worker(lang: str) -> None:
+    """Initialise the lexicon of a worker process which did not inherit it (e.g. under spawn)."""
+    initEmotionLexicon(lang=lang)
+    init_word_index()
 
-    words_dict['tweets'] += 1
-    stats['performance']['input']['tweets'] += 1
-    nobjs = stats['performance']['input']['tweets']
-    if (nobjs-1) % NTWEET == 0:
-        utils.dot()
+
+def count_words(texts: List[str]) -> dict:
+    """Count the words of a chunk of tweets w.r.t. their emotion (run by the worker processes).
+    """
+    words_dict = new_words_dict()
+    word_id = _WORD_IDS.get
+
+    # the texts are tokenized as a stream, so that spacy can work on batches of tweets;
+    # each word becomes the id of its lexicon entry, -1 if it is not in the lexicon
+    ids = np.fromiter(
+        (word_id(word, -1) for words in tokenizeMany(texts) for word in words),
+        dtype=np.int32
+    )
+    ids = ids[ids >= 0]
+
+    # the occurrences of each word, in order of first occurrence: the Counter keeps the
+    # insertion order, which breaks the ties in get_first_n_words
+    word_ids, first, occurrences = np.unique(ids, return_index=True, return_counts=True)
+    order = np.argsort(first, kind='stable')
+    word_ids = word_ids[order]
+    occurrences = occurrences[order]
+
+    # only the words of at least one relevant emotion can end up in the output
+    relevant = _RELEVANT_WORD[word_ids]
+    words_dict['occurrences'].update(dict(zip(
+        _WORDS[word_ids[relevant]].tolist(),
+        occurrences[relevant].tolist()
+    )))
+
+    words_dict['words'] = len(ids)
+    words_dict['tweets'] = len(texts)
+    return words_dict
+
+
+def count_chunks(
+        chunks: Iterable[List[str]],
+        lang: str,
+        args: argparse.Namespace) -> Iterator[dict]:
+    """Count the words of each chunk of tweets on args.processes processes, the results are
+       yielded in the order of the chunks.
+    """
+    if args.processes <= 1:
+        yield from map(count_words, chunks)
+        return
+
+    # forked workers already have the lexicon and its index, the others initialise their own
+    initializer, initargs = (None, ()) if workers_inherit_lexicon() else (init_worker, (lang,))
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.processes,
+            initializer=initializer,
+            initargs=initargs) as executor:
+        # bound the chunks in flight, so that the dump is not read in memory all at once
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(count_words, chunk))
+            if len(pending) >= 2 * args.processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 def get_first_n_words(
     stats: Mapping,
     words_dict: dict,
     args: argparse.Namespace):
-    for emotion, words in words_dict.items():
-        if emotion in RELEVANT_EMOTIONS:
-            sorted_words = [k for k, _ in sorted(words.items(), key=lambda item: item[1], reverse=True)]
-            n_words = args.n_words if len(sorted_words) >= args.n_words else len(sorted_words)
-            for i in range(n_words):
-                word = sorted_words[i]
-                yield {
-                    'word': word, 
-                    'occurrences': words[word], 
-                    'occ/words': words[word]/words_dict['words'], 
-                    'occ/tweets': words[word]/words_dict['tweets'], 
-                    'emotion': emotion
-                    }
+    """Yield the rows of the output file (in the order of fieldnames), the most frequent
+       words of each emotion.
+    """
+    n_words = words_dict['words']
+    n_tweets = words_dict['tweets']
+
+    # the words of each emotion, in the insertion order of the Counter
+    emotion_words = {emotion: [] for emotion in RELEVANT_EMOTIONS}
+    for word, occurrences in words_dict['occurrences'].items():
+        for emotion in getEmotionsOfWord(word):
+            name = EMOTION_ID_TO_NAME.get(emotion)
+            if name is not None:
+                emotion_words[name].append((word, occurrences))
+
+    for emotion, words in emotion_words.items():
+        # nlargest is stable, as most_common: equal counts keep the order of first occurrence
+        for word, occurrences in heapq.nlargest(args.n_words, words, key=itemgetter(1)):
+            yield (
+                word,
+                occurrences,
+                occurrences/n_words,
+                occurrences/n_tweets,
+                emotion
+                )
 
 
 def configure_subparsers(subparsers):
@@ -181,6 +297,13 @@ def configure_subparsers(subparsers):
         default=None,
         help='Optional file containing the users whose tweet will be considered in the process.',
     )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        required=False,
+        default=os.cpu_count() or 1,
+        help='The number of processes counting the words, 1 to count them in the main process [default: number of CPUs].',
+    )
 
     parser.set_defaults(func=main, which='calc_words_frequency')
 
@@ -206,19 +329,14 @@ def main(
         utils.log('the parameter --n-words cannot be lower than 1, exiting...')
         exit(1)
 
-    words_dict:dict = {}
-
-    for emotion in RELEVANT_EMOTIONS:
-        words_dict[emotion] = {}
+    if args.processes <= 0:
+        utils.log('the parameter --processes cannot be lower than 1, exiting...')
+        exit(1)
 
-    words_dict['words'] = 0
-    words_dict['tweets'] = 0
+    words_dict = new_words_dict()
 
     stats['performance']['start_time'] = datetime.datetime.utcnow()
 
-    output = open(os.devnull, 'wt')
-    stats_output = open(os.devnull, 'wt')
-
     # process the dump
     lang = process_lines(
         dump,
@@ -233,10 +351,32 @@ def main(
         args=args
     )
 
-    path_list = re.split('-|\.', basename)
+    path_list = _BASENAME_SPLIT(basename)
     date = f"{path_list[2]}-{path_list[3]}-{path_list[4]}"
 
+    fieldnames = ['word', 'occurrences', 'occ/words', 'occ/tweets', 'emotion']
+
+    # a dry run only counts the words: no csv of the top words, no stats file
     if not args.dry_run:
+        if not lang is None:
+            file_path = f"{args.output_dir_path}/words-frequency"
+            Path(file_path).mkdir(parents=True, exist_ok=True)
+
+            output_filename = f"{file_path}/{lang}-{path_list[0]}-{path_list[1]}-{date}-top-{args.n_words}-words.csv"
+
+            output = fu.output_writer(
+                path=output_filename,
+                compression=args.output_compression,
+                mode='wt'
+            )
+
+            writer = csv.writer(output)
+            writer.writerow(fieldnames)
+            writer.writerows(res)
+            output.close()
+
+        stats['performance']['end_time'] = datetime.datetime.utcnow()
+
         stats_path = f"{args.output_dir_path}/words-frequency/stats/{lang}"
         Path(stats_path).mkdir(parents=True, exist_ok=True)
         varname = ('{basename}.{func}'
@@ -252,33 +392,9 @@ def main(
             mode='wt'
         )
 
-        if not lang is None:
-            file_path = f"{args.output_dir_path}/words-frequency"
-            Path(file_path).mkdir(parents=True, exist_ok=True)
-
-            output_filename = f"{file_path}/{lang}-{path_list[0]}-{path_list[1]}-{date}-top-{args.n_words}-words.csv"
-
-            output = fu.output_writer(
-                path=output_filename,
-                compression=args.output_compression,
-                mode='wt'
+        with stats_output:
+            dumper.render_template(
+                stats_template,
+                stats_output,
+                stats=stats,
             )
-    
-    fieldnames = ['word', 'occurrences', 'occ/words', 'occ/tweets', 'emotion']
-
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    for line in res:
-        writer.writerow(line)
-    output.close()
-
-    stats['performance']['end_time'] = datetime.datetime.utcnow()
-    
-    with stats_output:
-        dumper.render_template(
-            stats_template,
-            stats_output,
-            stats=stats,
-        )
-    
-    stats_output.close()
\ No newline at end of file
@@ -13,6 +13,7 @@ import re
 import argparse
 import datetime
 from pathlib import Path
+from itertools import chain
 from m3inference import M3Twitter
 from m3inference.consts import TW_DEFAULT_PROFILE_IMG
 
@@ -29,6 +30,12 @@ from pprint import pprint
 # print a dot each NTWEET tweets
 NTWEET = 10000
 
+# write the m3inference input in batches of WRITE_BATCH lines
+WRITE_BATCH = 10000
+
+# split the basename of the input file on '-' and '.'
+_BASENAME_SPLIT = re.compile(r'[-.]').split
+
 # templates
 stats_template = '''
 <stats>
@@ -65,16 +72,23 @@ fieldnames = [
     "org_acc"
 ]
 
+# age groups of m3inference, in the order of fieldnames
+AGE_GROUPS = (">=40", "30-39", "19-29", "<=18")
+
+# extract the accuracies inferred by m3inference in a single call
+_get_gender_accs = itemgetter('female', 'male')
+_get_age_accs = itemgetter(*AGE_GROUPS)
+_get_org_accs = itemgetter('is-org', 'non-org')
+
 
 def process_lines(
         dump: io.TextIOWrapper,
         stats: Mapping,
         args:argparse.Namespace,
-        shared: dict,
-        m3twitter:M3Twitter
-        ) -> Iterator[list]:
+        shared: dict
+        ) -> Iterator[dict]:
     """It checks for each line (user) if the number of tweets is above a certain minimum and if
-       it is the case, it uses transform_jsonl_object to get a particular dict to perform 
+       it is the case, it yields the user so that write_m3_input can transform it to perform
        inference later on
     """
 
@@ -88,27 +102,117 @@ def process_lines(
             if user['profile_image_url_https'] == "":
                 user['default_profile_image'] = True
                 stats['performance']['input']['img_errors'] += 1
-            yield m3twitter.transform_jsonl_object(user)
-
-def init_user(user:dict) -> dict:
-    return {
-        "id_str": user["id_str"],
-        "screen_name": user["screen_name"],
-        "name": user["name"],
-        "tweets": user["tweets"],
-        "days_tweeted": user["days_tweeted"],
-        "location": user["location"],
-        "gender": "",
-        "gender_acc": -1,
-        "age": "",
-        "age_acc": -1,
-        "age_>=40_acc": -1,
-        "age_30-39_acc": -1,
-        "age_19-29_acc": -1,
-        "age_<=18_acc": -1,
-        "org": False,
-        "org_acc": -1
-    }
+            yield user
+
+class InferredUser:
+    """The profile of a user to infer, the first fields of the output csv (see fieldnames).
+
+       __slots__ avoids the per-instance dict, there can be millions of users. The inferred
+       values are not stored: each row is written as soon as it is built.
+    """
+    __slots__ = (
+        "id_str",
+        "screen_name",
+        "name",
+        "tweets",
+        "days_tweeted",
+        "location"
+    )
+
+    def __init__(self, user: dict):
+        self.id_str = user["id_str"]
+        self.screen_name = user["screen_name"]
+        self.name = user["name"]
+        self.tweets = user["tweets"]
+        self.days_tweeted = user["days_tweeted"]
+        self.location = user["location"]
+
+    def __iter__(self) -> Iterator:
+        """Values of the profile in the order of fieldnames."""
+        yield self.id_str
+        yield self.screen_name
+        yield self.name
+        yield self.tweets
+        yield self.days_tweeted
+        yield self.location
+
+
+def init_user(user:dict) -> InferredUser:
+    return InferredUser(user)
+
+
+def write_m3_input(
+        users: Iterable[dict],
+        m3twitter: M3Twitter,
+        m3_input_file: str,
+        stats: Mapping) -> None:
+    """Write the input file of m3inference, transforming each user with transform_jsonl_object."""
+    output = fu.output_writer(
+        path=m3_input_file,
+        compression=None,
+        mode='wt'
+    )
+
+    batch = []
+    listings = {}
+    for user in users:
+        obj = m3twitter.transform_jsonl_object(user)
+        # handle error while downloading an image
+        if not image_exists(obj['img_path'], listings):
+            obj['img_path'] = TW_DEFAULT_PROFILE_IMG
+            stats['performance']['input']['img_errors'] += 1
+        batch.append(json.dumps(obj) + "\n")
+        if len(batch) >= WRITE_BATCH:
+            output.writelines(batch)
+            batch.clear()
+    output.writelines(batch)
+
+    output.close()
+
+
+def inferred_row(user: InferredUser, inferred_user_stats: dict) -> tuple:
+    """Row of the output csv (in the order of fieldnames) of a user inferred by m3inference."""
+    female, male = _get_gender_accs(inferred_user_stats['gender'])
+    if female >= male:
+        gender, gender_acc = 'female', female
+    else:
+        gender, gender_acc = 'male', male
+
+    age_accs = _get_age_accs(inferred_user_stats['age'])
+
+    over_40 = age_accs[0]
+    if over_40 >= 1 - over_40:
+        age, age_acc = '>=40', over_40
+    else:
+        age, age_acc = '<40', 1 - over_40
+
+    is_org, non_org = _get_org_accs(inferred_user_stats['org'])
+    if is_org >= non_org:
+        org, org_acc = True, is_org
+    else:
+        org, org_acc = False, non_org
+
+    return (*user, gender, gender_acc, age, age_acc, *age_accs, org, org_acc)
+
+
+def list_dir(path: str) -> set:
+    """Names of the entries of a directory, read with a single os.scandir."""
+    try:
+        with os.scandir(path or '.') as entries:
+            return {entry.name for entry in entries}
+    except OSError:
+        return set()
+
+
+def image_exists(img_path: str, listings: dict) -> bool:
+    """Check if an image exists without a stat for each user: the directory of the image is
+       listed once and cached in listings. Only the images missing from the listing (e.g. the
+       ones m3inference downloaded after it was taken) are checked on disk.
+    """
+    img_dir, img_name = os.path.split(img_path)
+    if img_dir not in listings:
+        listings[img_dir] = list_dir(img_dir)
+    return img_name in listings[img_dir] or os.path.exists(img_path)
 
 
 def configure_subparsers(subparsers):
@@ -162,63 +266,43 @@ def main(
     
     stats['performance']['start_preprocess'] = datetime.datetime.utcnow()
     cache_dir=f"{args.output_dir_path}/twitter_cache_{args.cache_dir}"
-    m3twitter=M3Twitter(cache_dir=cache_dir, use_full_model=True)
 
     # process the dump
     res = process_lines(
         dump,
         stats=stats,
         args=args,
-        shared=shared,
-        m3twitter=m3twitter
+        shared=shared
     )
 
-    m3_input_file = f"{cache_dir}/m3_input.jsonl"
-    output = fu.output_writer(
-        path=m3_input_file,
-        compression=None,
-        mode='wt'
-    )
+    # M3Twitter loads the models in memory, create it only if there is a user to infer
+    first = next(res, None)
+    if first is not None:
+        m3twitter = M3Twitter(cache_dir=cache_dir, use_full_model=True)
+        m3_input_file = f"{cache_dir}/m3_input.jsonl"
+        write_m3_input(chain([first], res), m3twitter, m3_input_file, stats)
 
-    for obj in res:
-        # handle error while downloading an image
-        if not os.path.exists(obj['img_path']):
-            obj['img_path'] = TW_DEFAULT_PROFILE_IMG
-            stats['performance']['input']['img_errors'] += 1
-        output.write(json.dumps(obj))
-        output.write("\n")
-    
-    output.close()
+        stats['performance']['end_preprocess'] = datetime.datetime.utcnow()
 
-    stats['performance']['end_preprocess'] = datetime.datetime.utcnow()
+        stats['performance']['start_infer'] = datetime.datetime.utcnow()
 
-    stats['performance']['start_infer'] = datetime.datetime.utcnow()
-    
-    inferred_users = m3twitter.infer(m3_input_file)
+        inferred_users = m3twitter.infer(m3_input_file)
+    else:
+        utils.log('No user to infer, skipping m3inference')
+
+        # nothing to preprocess nor to infer
+        now = datetime.datetime.utcnow()
+        stats['performance']['end_preprocess'] = now
+        stats['performance']['start_infer'] = now
+
+        inferred_users = {}
 
-    stats_output = open(os.devnull, 'wt')
-    output = open(os.devnull, 'wt')
+    # a dry run still infers the users, but writes neither their csv nor the stats
     if not args.dry_run:
         # extract useful info from the name
-        path_list = re.split('-|\.', basename)
+        path_list = _BASENAME_SPLIT(basename)
         lang = path_list[0]
 
-        stats_path = f"{args.output_dir_path}/infer-users/stats/{lang}"
-        Path(stats_path).mkdir(parents=True, exist_ok=True)
-        varname = ('{basename}-{pid}.{func}'
-                   .format(basename=basename,
-                           pid=os.getpid(),
-                           func='infer-users'
-                           )
-                   )
-        stats_filename = f"{stats_path}/{varname}.stats.xml"
-
-        stats_output = fu.output_writer(
-            path=stats_filename,
-            compression=args.output_compression,
-            mode='wt'
-        )
-
         file_path = f"{args.output_dir_path}/infer-users"
         Path(file_path).mkdir(parents=True, exist_ok=True)
 
@@ -230,61 +314,46 @@ def main(
             mode='wt'
         )
 
-    utils.log('Writing the results...')
-
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    for user in inferred_users:
-        if user in shared:
-            user_dict = shared[user]
-            inferred_user_stats = inferred_users[user]
-
-            inferred_gender = inferred_user_stats['gender']
-            if inferred_gender['female'] >= inferred_gender['male']:
-                user_dict['gender'] = 'female'
-                user_dict['gender_acc'] = inferred_gender['female']
-            else:
-                user_dict['gender'] = 'male'
-                user_dict['gender_acc'] = inferred_gender['male']
-
-            inferred_age = inferred_user_stats['age']
-
-            for age, accuracy in inferred_age.items():
-                user_dict[f'age_{age}_acc'] = accuracy
-
-            if inferred_age['>=40'] >= 1 - inferred_age['>=40']:
-                user_dict['age'] = '>=40'
-                user_dict['age_acc'] = inferred_age['>=40']
-            else:
-                user_dict['age'] = '<40'
-                user_dict['age_acc'] = 1 - inferred_age['>=40']
-
-            inferred_org = inferred_user_stats['org']
-            if inferred_org['is-org'] >= inferred_org['non-org']:
-                user_dict['org'] = True
-                user_dict['org_acc'] = inferred_org['is-org']
-            else:
-                user_dict['org'] = False
-                user_dict['org_acc'] = inferred_org['non-org']
-
-            writer.writerow(user_dict)
+        utils.log('Writing the results...')
 
-    output.close()
+        writer = csv.writer(output)
+        writer.writerow(fieldnames)
+        writer.writerows(
+            inferred_row(shared[user], inferred_user_stats)
+            for user, inferred_user_stats in inferred_users.items()
+            if user in shared
+        )
+
+        output.close()
+
+        utils.log('Finished to write results')
 
-    utils.log('Finished to write results')
+        stats['performance']['end_infer'] = datetime.datetime.utcnow()
 
-    stats['performance']['end_infer'] = datetime.datetime.utcnow()
+        stats_path = f"{args.output_dir_path}/infer-users/stats/{lang}"
+        Path(stats_path).mkdir(parents=True, exist_ok=True)
+        varname = ('{basename}-{pid}.{func}'
+                   .format(basename=basename,
+                           pid=os.getpid(),
+                           func='infer-users'
+                           )
+                   )
+        stats_filename = f"{stats_path}/{varname}.stats.xml"
 
-    with stats_output:
-        dumper.render_template(
-            stats_template,
-            stats_output,
-            stats=stats,
+        stats_output = fu.output_writer(
+            path=stats_filename,
+            compression=args.output_compression,
+            mode='wt'
         )
-    
-    stats_output.close()
 
-    if args.delete:
+        with stats_output:
+            dumper.render_template(
+                stats_template,
+                stats_output,
+                stats=stats,
+            )
+
+    if args.delete and os.path.isdir(cache_dir):
         try:
             utils.log("Deleting cache directory")
             shutil.rmtree(cache_dir)